@@ -0,0 +1,54 @@
+import re
+
+# Shared pieces of the page-classification prompts. Every pipeline keeps its
+# own static SYSTEM_PROMPT first and byte-identical on every call, with the
+# page text last, so OpenAI can serve the shared prefix from its prompt cache
+
+# One small model for every page-classification call
+CLASSIFIER_MODEL = "gpt-4o-mini"
+
+# Cheap local prefilter: a page with a North American ID on it names the
+# country or the document type somewhere, so pages without any of these
+# words are never sent to OpenAI
+NA_RE = re.compile(
+    r"\b(?:united\s+states|u\.?s\.?a\b|canad(?:a|ian)|m[eé]xic(?:o|an)|estados\s+unidos"
+    r"|passport|passeport|pasaporte|driver'?s?\s+licen[sc]e|green\s+card|permanent\s+resident"
+    r"|visa|dmv|ssn)",
+    re.IGNORECASE,
+)
+
+def page_matches_format(*fields):
+    """
+    Strict structured-output response_format for {"matches": [...]}, where
+    every match has an integer "page" plus the given string fields.
+    Decoding is constrained to this schema, so the smaller model cannot
+    return malformed or differently shaped JSON.
+    """
+    properties = {"page": {"type": "integer"}}
+    properties.update({field: {"type": "string"} for field in fields})
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "page_matches",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "matches": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": properties,
+                            "required": list(properties),
+                            "additionalProperties": False,
+                        },
+                    },
+                },
+                "required": ["matches"],
+                "additionalProperties": False,
+            },
+        },
+    }
+
+# Answer shape of the three North American ID pipelines
+NA_RESPONSE_FORMAT = page_matches_format("country_detected", "doc_type")
@@ -1,9 +1,30 @@
+import argparse
+import os
+import tempfile
+import numpy as np
+import pymupdf
 import torch
-from pdf2image import convert_from_path
+import torch.nn.functional as F
+from PIL import Image
 from transformers import CLIPProcessor, CLIPModel
+from page_stream import iter_pages, iter_batches, page_digest, prefetch
 
 INPUT_PDF = "./input/school-text-ocr-test.pdf"
 CONFIDENCE_THRESHOLD = 0.70 
+BATCH_SIZE = 16
+# CLIP resizes to 224x224, so the page only needs enough detail to survive that
+CLIP_DPI = 150
+
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+# Use float16 on CUDA for memory savings and tensor cores; otherwise float32
+MODEL_DTYPE = torch.float16 if DEVICE == "cuda" else torch.float32
+# Compile the image tower with torch.compile (inductor) for the fixed input size
+COMPILE_MODEL = True
+
+# Quantized CPU backend: the smallest GGUF in the repo is picked unless a file is given
+GGML_MODEL = "mys/ggml_clip-vit-base-patch32"
+# exp(logit_scale) of the OpenAI CLIP checkpoints
+GGML_LOGIT_SCALE = 100.0
 
 LABELS = [
     "a photo or drawing of a hill or mountain",
@@ -11,52 +32,174 @@ LABELS = [
     "a photo or drawing of a house or building",
 ]
 
-def main():
-    print("1. Loading CLIP Model...")
-    model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
+def autocast():
+    """
+    Mixed-precision context for inference; a no-op on CPU.
+    """
+    return torch.autocast(device_type=DEVICE, dtype=torch.float16, enabled=DEVICE == "cuda")
+
+def compile_vision_model(model, processor):
+    """
+    Compiles CLIP's image tower and warms it up at BATCH_SIZE so the compile
+    cost is not billed to the first real batch. Falls back to eager mode if
+    compilation is not supported on this machine; returns whether the
+    compiled tower is in use.
+    """
+    torch.set_float32_matmul_precision("high")
+    model.vision_model = torch.compile(model.vision_model, mode="reduce-overhead")
+
+    crop = processor.image_processor.crop_size
+    dummy = torch.zeros(BATCH_SIZE, 3, crop["height"], crop["width"], device=DEVICE, dtype=MODEL_DTYPE)
+    try:
+        with torch.inference_mode(), autocast():
+            model.get_image_features(pixel_values=dummy)
+    except Exception as e:
+        print(f"   torch.compile unavailable, running eagerly: {e}")
+        model.vision_model = model.vision_model._orig_mod
+        return False
+    return True
+
+def load_hf_scorer():
+    """
+    Loads the Hugging Face CLIP model and returns a function that maps a batch
+    of page images to a [N, len(LABELS)] tensor of label probabilities.
+    """
+    model = CLIPModel.from_pretrained(
+        "openai/clip-vit-base-patch32",
+        torch_dtype=MODEL_DTYPE
+    ).to(DEVICE).eval()
+    # Nothing here trains, so autograd stays off outside the inference_mode blocks too
+    torch.set_grad_enabled(False)
     processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
 
-    print(f"2. Converting PDF '{INPUT_PDF}' to images...")
+    # LABELS never change, so encode them once instead of once per batch
+    text_inputs = processor.tokenizer(LABELS, return_tensors="pt", padding=True).to(DEVICE)
+    with torch.inference_mode(), autocast():
+        text_features = F.normalize(model.get_text_features(**text_inputs), dim=-1)
+        logit_scale = model.logit_scale.exp()
+
+    # The compiled tower's CUDA graph is captured at BATCH_SIZE, so smaller
+    # batches (deduplicated pages, the last batch) are padded up to it
+    # rather than triggering a recompile per new batch size
+    pad_to_batch = COMPILE_MODEL and compile_vision_model(model, processor)
+
+    def score_batch(batch):
+        # Prepare inputs for the whole batch of pages (image tower only)
+        inputs = processor(images=batch, return_tensors="pt")
+        pixel_values = inputs["pixel_values"].to(DEVICE, dtype=MODEL_DTYPE)
+        num_pages = pixel_values.shape[0]
+        if pad_to_batch and num_pages < BATCH_SIZE:
+            pixel_values = F.pad(pixel_values, (0, 0, 0, 0, 0, 0, 0, BATCH_SIZE - num_pages))
+
+        # Run the model (inference_mode skips autograd bookkeeping entirely)
+        with torch.inference_mode(), autocast():
+            image_features = F.normalize(model.get_image_features(pixel_values=pixel_values), dim=-1)
+            logits_per_image = logit_scale * image_features @ text_features.T
+
+        # Get probabilities (softmax makes them add up to 100%), one row per page
+        return logits_per_image[:num_pages].float().softmax(dim=1)
+
+    return score_batch
+
+def load_ggml_scorer(model_path):
+    """
+    Loads a GGML-quantized CLIP (e.g. Q4_0) through clip.cpp for CPU-only
+    machines and returns the same kind of scoring function as load_hf_scorer.
+    """
+    # Optional dependency, only needed for this backend (pip install clip-cpp)
+    from clip_cpp import Clip
+
+    model = Clip(model_path_or_repo_id=model_path)
+    image_size = model.vision_config["image_size"]
+
+    # Embeddings come back L2-normalised; encode the constant LABELS once
+    text_features = torch.tensor(
+        [model.encode_text(model.tokenize(label)) for label in LABELS]
+    )
+
+    def score_batch(batch):
+        image_features = []
+        # clip.cpp only loads images from disk, so hand it a small uncompressed
+        # copy already shrunk to the model's input size
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for idx, image in enumerate(batch):
+                scale = image_size / min(image.size)
+                if scale < 1:
+                    image = image.resize(
+                        (round(image.width * scale), round(image.height * scale)),
+                        Image.Resampling.BILINEAR
+                    )
+                image_path = os.path.join(tmp_dir, f"page-{idx}.bmp")
+                image.save(image_path)
+                image_features.append(model.load_preprocess_encode_image(image_path))
+
+        logits_per_image = GGML_LOGIT_SCALE * torch.tensor(image_features) @ text_features.T
+        return logits_per_image.softmax(dim=1)
+
+    return score_batch
+
+def main(backend="hf", ggml_model=GGML_MODEL):
+    print(f"1. Loading CLIP Model ({backend} backend)...")
+    if backend == "ggml":
+        score_batch = load_ggml_scorer(ggml_model)
+    else:
+        score_batch = load_hf_scorer()
+
+    print(f"2. Opening PDF '{INPUT_PDF}'...")
     try:
-        images = convert_from_path(INPUT_PDF, dpi=200)
+        doc = pymupdf.open(INPUT_PDF)
     except Exception as e:
-        print(f"Error converting PDF: {e}")
+        print(f"Error opening PDF: {e}")
         return
 
-    print(f"3. Analyzing {len(images)} pages for objects...")
+    print(f"3. Analyzing {doc.page_count} pages for objects...")
     print("-" * 60)
 
-    for i, image in enumerate(images):
-        page_num = i + 1
-        
-        # Prepare inputs for the model
-        inputs = processor(
-            text=LABELS, 
-            images=image, 
-            return_tensors="pt", 
-            padding=True
-        )
-
-        # Run the model (no_grad disables training mode to save memory)
-        with torch.no_grad():
-            outputs = model(**inputs)
-            
-        # Get probabilities (softmax makes them add up to 100%)
-        probs = outputs.logits_per_image.softmax(dim=1)[0]
-
-        print(f"Page {page_num}:")
-        found_match = False
-        
-        for idx, label in enumerate(LABELS):
-            score = probs[idx].item()
+    # Page digest -> label probabilities, for skipping repeated pages
+    page_probs = {}
+
+    batches = iter_batches(iter_pages(doc, dpi=CLIP_DPI), BATCH_SIZE)
+    # Render the next batch on a background thread while this one is scored
+    for batch_idx, batch in enumerate(prefetch(batches, maxsize=1)):
+        i = batch_idx * BATCH_SIZE
+
+        # Only score pages whose exact content has not been seen yet
+        digests = [page_digest(image) for image in batch]
+        unseen = {}
+        for digest, image in zip(digests, batch):
+            if digest not in page_probs:
+                unseen.setdefault(digest, image)
+        if unseen:
+            # A single device-to-host copy per batch instead of one sync per score
+            page_probs.update(zip(unseen, score_batch(list(unseen.values())).cpu().numpy()))
+        probs = np.stack([page_probs[digest] for digest in digests])
+        hits = probs > CONFIDENCE_THRESHOLD
+
+        for offset in range(len(batch)):
+            page_num = i + offset + 1
+
+            print(f"Page {page_num}:")
+            found = np.flatnonzero(hits[offset])
+
+            for idx in found:
+                print(f"  [FOUND] {LABELS[idx]} ({probs[offset, idx]:.1%})")
             
-            if score > CONFIDENCE_THRESHOLD:
-                print(f"  [FOUND] {label} ({score:.1%})")
-                found_match = True
-        
-        if not found_match:
-            print("  (No significant objects found)")
-        print("-" * 60)
+            if found.size == 0:
+                print("  (No significant objects found)")
+            print("-" * 60)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Detect objects in PDF pages with CLIP.")
+    parser.add_argument(
+        "--backend",
+        choices=["hf", "ggml"],
+        default="hf",
+        help="hf: transformers CLIP (GPU/FP16 when available); ggml: quantized clip.cpp for CPU"
+    )
+    parser.add_argument(
+        "--ggml-model",
+        default=GGML_MODEL,
+        help="GGUF file, directory or Hugging Face repo for the ggml backend"
+    )
+    args = parser.parse_args()
+    main(backend=args.backend, ggml_model=args.ggml_model)
\ No newline at end of file
@@ -1,84 +1,294 @@
 import os
+import asyncio
+import multiprocessing
 import json
+import httpx
 from dotenv import load_dotenv
-from openai import OpenAI
-from pdf2image import convert_from_path
-from pypdf import PdfReader, PdfWriter
+from openai import AsyncOpenAI
+import pymupdf
+import numpy as np
 from PIL import Image
 
 import torch
 from transformers import AutoProcessor, AutoModelForVision2Seq
+from classification import CLASSIFIER_MODEL, NA_RE, NA_RESPONSE_FORMAT
+from page_stream import iter_pages, iter_batches, prefetch, prefetch_async
 
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Concurrent batch requests are multiplexed over one keep-alive HTTP/2
+# connection instead of each opening its own TLS session
+http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=60.0,
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64)
+)
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client)
 
 INPUT_PDF = "./input/anyline-sample-scan-book-ocr.pdf"
 OUTPUT_DIR = "./output"
 OUTPUT_FILENAME = "anyline-sample-scan-book-ocr-deepseek.pdf"
 BATCH_SIZE = 10
+MAX_CONCURRENT_REQUESTS = 8
+# OCR of fine print keeps full 300 DPI
+OCR_DPI = 300
 
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+NUM_GPUS = torch.cuda.device_count()
 OCR_MODEL_ID = "deepseek-ai/DeepSeek-OCR-2"
 
-print(f"Loading OCR model {OCR_MODEL_ID} on {DEVICE}... (this may take a minute)")
-try:
-    ocr_processor = AutoProcessor.from_pretrained(OCR_MODEL_ID, trust_remote_code=True)
-    model_dtype = torch.float16 if DEVICE == "cuda" else torch.float32
-    ocr_model = AutoModelForVision2Seq.from_pretrained(
-        OCR_MODEL_ID,
-        torch_dtype=model_dtype,
-        trust_remote_code=True
-    ).to(DEVICE)
-    ocr_model.eval()
-except Exception as e:
-    print("Error loading DeepSeek OCR model:", e)
-    raise
-
-def ocr_image(image: Image.Image) -> str:
-    """
-    Runs DeepSeek-OCR-2 on a PIL image and returns extracted text.
-    This replaces the previous pytesseract.image_to_string call.
-    """
-    if image.mode != "RGB":
-        image = image.convert("RGB")
-
-    # Processor expects images argument; returns tensors keyed (commonly 'pixel_values')
-    inputs = ocr_processor(images=image, return_tensors="pt")
-    # Move tensors to DEVICE
-    inputs = {k: v.to(DEVICE) for k, v in inputs.items()}
+model_dtype = torch.float16 if DEVICE == "cuda" else torch.float32
+
+# Set by load_ocr_model() in every process that runs OCR
+ocr_processor = None
+ocr_model = None
+# Host-to-device copies get their own stream so the next batch uploads while
+# the current one is generating
+COPY_STREAM = None
+# Image geometry and normalisation of the processor, read once in
+# load_ocr_model() so pages can be turned into pixel_values on the device.
+# PIXEL_SIZE is None when the processor's output size varies per page
+PIXEL_SIZE = None
+PIXEL_PAD = False
+PIXEL_FILL = (127, 127, 127)
+PIXEL_RESAMPLE = Image.Resampling.BICUBIC
+PIXEL_SCALE = 1 / 255
+PIXEL_MEAN = None
+PIXEL_STD = None
+# Whether the device-side path reproduces the processor's pixel_values;
+# None until checked against the first page
+FAST_PIXELS = None
+
+# The image encoder always sees the same input shape, so let cuDNN benchmark
+# and keep the fastest convolution algorithms
+torch.backends.cudnn.benchmark = True
+
+def load_ocr_model():
+    """
+    Loads the DeepSeek-OCR-2 processor and model onto the current device.
+    Called once per OCR process rather than at import time, so spawned GPU
+    workers do not each load a copy onto the default GPU.
+    """
+    global ocr_processor, ocr_model, COPY_STREAM
+    global PIXEL_SIZE, PIXEL_PAD, PIXEL_FILL, PIXEL_RESAMPLE, PIXEL_SCALE, PIXEL_MEAN, PIXEL_STD
+
+    print(f"Loading OCR model {OCR_MODEL_ID} on {DEVICE}... (this may take a minute)")
+    try:
+        ocr_processor = AutoProcessor.from_pretrained(OCR_MODEL_ID, trust_remote_code=True)
+        # Batched decoder-only generation needs left padding so every prompt ends
+        # at the same position and ragged outputs decode correctly
+        if getattr(ocr_processor, "tokenizer", None) is not None:
+            ocr_processor.tokenizer.padding_side = "left"
+        ocr_model = AutoModelForVision2Seq.from_pretrained(
+            OCR_MODEL_ID,
+            torch_dtype=model_dtype,
+            trust_remote_code=True
+        ).to(DEVICE)
+        ocr_model.eval()
+    except Exception as e:
+        print("Error loading DeepSeek OCR model:", e)
+        raise
+
+    COPY_STREAM = torch.cuda.Stream() if DEVICE == "cuda" else None
+
+    image_processor = getattr(ocr_processor, "image_processor", ocr_processor)
+    PIXEL_SIZE, PIXEL_PAD = pixel_geometry(image_processor)
+    PIXEL_RESAMPLE = Image.Resampling(int(getattr(image_processor, "resample", Image.Resampling.BICUBIC)))
+    do_rescale = getattr(image_processor, "do_rescale", True)
+    PIXEL_SCALE = getattr(image_processor, "rescale_factor", 1 / 255) if do_rescale else 1.0
+    if getattr(image_processor, "do_normalize", True):
+        mean = getattr(image_processor, "image_mean", None) or [0.5, 0.5, 0.5]
+        std = getattr(image_processor, "image_std", None) or [0.5, 0.5, 0.5]
+    else:
+        mean, std = [0.0, 0.0, 0.0], [1.0, 1.0, 1.0]
+    # Padding is the mean colour, which normalises to zero
+    PIXEL_FILL = tuple(round(m / PIXEL_SCALE) for m in mean)
+    PIXEL_MEAN = torch.tensor(mean, device=DEVICE, dtype=model_dtype).view(1, 3, 1, 1)
+    PIXEL_STD = torch.tensor(std, device=DEVICE, dtype=model_dtype).view(1, 3, 1, 1)
+
+def pixel_geometry(image_processor):
+    """
+    Returns ((width, height), pad) of the processor's model input, where pad
+    means an aspect-preserving resize onto a square canvas. The size is None
+    when the processor keeps the aspect ratio without padding, so pages
+    come out in different shapes and have to go through the processor.
+    Raises ValueError on a `size` this script does not know how to follow.
+    """
+    if not getattr(image_processor, "do_resize", True):
+        return None, False
+    size = getattr(image_processor, "size", None)
+    if isinstance(size, int):
+        return (size, size), False
+    keys = set(size or ())
+    if keys == {"height", "width"}:
+        return (size["width"], size["height"]), False
+    if keys == {"longest_edge"} and getattr(image_processor, "do_pad", False):
+        return (size["longest_edge"], size["longest_edge"]), True
+    if keys and keys <= {"shortest_edge", "longest_edge"}:
+        return None, False
+    raise ValueError(f"Unsupported image processor size {size!r}")
+
+def fit_page(image):
+    """
+    Resizes an RGB page to PIXEL_SIZE the way the processor does: a plain
+    resize, or with PIXEL_PAD an aspect-preserving one centred on a canvas
+    filled with the mean colour.
+    """
+    if image.size == PIXEL_SIZE:
+        return image
+    if not PIXEL_PAD:
+        return image.resize(PIXEL_SIZE, PIXEL_RESAMPLE)
+    side = PIXEL_SIZE[0]
+    scale = side / max(image.size)
+    resized = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), PIXEL_RESAMPLE)
+    canvas = Image.new("RGB", PIXEL_SIZE, PIXEL_FILL)
+    canvas.paste(resized, ((side - resized.width) // 2, (side - resized.height) // 2))
+    return canvas
+
+def processor_inputs(images):
+    """
+    Runs the processor's own image pipeline on a batch, as this script did
+    before the device-side path.
+    """
+    return ocr_processor(images=images, return_tensors="pt", padding=True)
+
+def fast_pixels_match(image, pixel_values):
+    """
+    Compares the device-side pixel_values of one page with what the
+    processor produces for it; any extra processor output, a different
+    shape or values off by more than fp16 rounding fails the check.
+    """
+    reference = processor_inputs([image])
+    if set(reference) != {"pixel_values"}:
+        return False
+    expected = reference["pixel_values"][0].float()
+    actual = pixel_values[0].float().cpu()
+    return actual.shape == expected.shape and (actual - expected).abs().max().item() <= 1e-2
+
+def prepare_batch(images: list[Image.Image]):
+    """
+    Turns a batch of PIL images into normalised pixel_values. Pages are
+    resized as the processor would (fit_page) and copied as uint8 into one
+    (pinned) host tensor, uploaded on COPY_STREAM, and only then cast and
+    normalised on DEVICE. The first batch is checked against the processor's
+    own output; if the processor's geometry is not fixed or the check fails,
+    every batch goes through the processor instead. Returns the device
+    inputs and a CUDA event marking the end of the copy (None on CPU).
+    """
+    global FAST_PIXELS
+    images = [image if image.mode == "RGB" else image.convert("RGB") for image in images]
+
+    if PIXEL_SIZE is None:
+        FAST_PIXELS = False
+    if FAST_PIXELS is False:
+        host_inputs = processor_inputs(images)
+        if COPY_STREAM is None:
+            return {k: v.to(DEVICE) for k, v in host_inputs.items()}, None
+        with torch.cuda.stream(COPY_STREAM):
+            inputs = {k: v.pin_memory().to(DEVICE, non_blocking=True) for k, v in host_inputs.items()}
+        return inputs, COPY_STREAM.record_event()
+
+    width, height = PIXEL_SIZE
+    pixels = torch.empty((len(images), height, width, 3), dtype=torch.uint8, pin_memory=COPY_STREAM is not None)
+    for i, image in enumerate(images):
+        # Write the page straight into the batch tensor through a numpy view
+        pixels[i].numpy()[...] = np.asarray(fit_page(image))
+
+    def to_pixel_values():
+        # uint8 crosses the bus (4x less than float32); the cast and
+        # normalisation run in place on the device
+        px = pixels.to(DEVICE, non_blocking=True).permute(0, 3, 1, 2).to(model_dtype)
+        return {"pixel_values": px.mul_(PIXEL_SCALE).sub_(PIXEL_MEAN).div_(PIXEL_STD)}
+
+    if COPY_STREAM is None:
+        inputs, copy_done = to_pixel_values(), None
+    else:
+        with torch.cuda.stream(COPY_STREAM):
+            inputs = to_pixel_values()
+        copy_done = COPY_STREAM.record_event()
+
+    if FAST_PIXELS is None:
+        if copy_done is not None:
+            copy_done.synchronize()
+        FAST_PIXELS = fast_pixels_match(images[0], inputs["pixel_values"])
+        if not FAST_PIXELS:
+            print("Device-side pixel_values differ from the processor's, using the processor.")
+            return prepare_batch(images)
+    return inputs, copy_done
+
+def ocr_batch(inputs, copy_done=None) -> list[str]:
+    """
+    Runs DeepSeek-OCR-2 on a prepared batch and returns the extracted text
+    for each page, in order, from a single generate call.
+    """
+    if copy_done is not None:
+        # Wait for the upload on the compute stream and let the caching
+        # allocator know the tensors are now used there
+        stream = torch.cuda.current_stream()
+        stream.wait_event(copy_done)
+        for v in inputs.values():
+            v.record_stream(stream)
 
     try:
-        with torch.no_grad():
+        with torch.inference_mode(), torch.autocast(device_type=DEVICE, dtype=model_dtype, enabled=DEVICE == "cuda"):
             # generate may accept the same inputs; keep generation conservative
             generated_ids = ocr_model.generate(
                 **inputs,
                 max_new_tokens=1024,  # reasonable cap per page
-                do_sample=False
+                do_sample=False,
+                num_beams=1,
+                use_cache=True
             )
     except Exception as e:
         # Retry with smaller token limit if generation fails
         print("OCR generation error (retrying with smaller max_new_tokens):", e)
-        with torch.no_grad():
+        with torch.inference_mode(), torch.autocast(device_type=DEVICE, dtype=model_dtype, enabled=DEVICE == "cuda"):
             generated_ids = ocr_model.generate(
                 **inputs,
                 max_new_tokens=512,
-                do_sample=False
+                do_sample=False,
+                num_beams=1,
+                use_cache=True
             )
 
-    # Decode to text
-    text = ocr_processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
-    return text
+    # Decode to text, one string per page
+    return ocr_processor.batch_decode(generated_ids, skip_special_tokens=True)
 
-def analyze_batch(ocr_texts, start_page_num):
-    pages_block = []
-    for i, text in enumerate(ocr_texts):
-        page_no = start_page_num + i
-        pages_block.append(
-            f"\n--- PAGE {page_no} ---\n{text.strip()}"
-        )
+def ocr_worker(gpu_id, page_numbers):
+    """
+    Entry point of a spawned OCR process: loads a model replica on `gpu_id`
+    and OCRs the given 1-based page numbers. Returns (page, text) pairs.
+    """
+    torch.cuda.set_device(gpu_id)
+    load_ocr_model()
+
+    texts = []
+    with pymupdf.open(INPUT_PDF) as doc:
+        pages = (doc[p - 1] for p in page_numbers)
+        batches = iter_batches(iter_pages(pages, dpi=OCR_DPI), BATCH_SIZE)
+        staged = (prepare_batch(batch) for batch in batches)
+        for inputs, copy_done in prefetch(staged, maxsize=1):
+            texts.extend(ocr_batch(inputs, copy_done))
+
+    return list(zip(page_numbers, texts))
+
+def ocr_multi_gpu(total_pages):
+    """
+    Deals the document's BATCH_SIZE page batches round-robin to one worker
+    process per GPU, each with its own model replica, and returns
+    {page_number: text}.
+    """
+    shards = [[] for _ in range(NUM_GPUS)]
+    for k, start in enumerate(range(1, total_pages + 1, BATCH_SIZE)):
+        shards[k % NUM_GPUS].extend(range(start, min(start + BATCH_SIZE, total_pages + 1)))
+
+    # CUDA cannot be re-initialised in a forked child, so workers are spawned
+    with multiprocessing.get_context("spawn").Pool(NUM_GPUS) as pool:
+        results = pool.starmap(ocr_worker, enumerate(shards))
+
+    return dict(pair for shard in results for pair in shard)
 
-    prompt = f"""
-Analyze the following OCR-extracted text from document pages.
+SYSTEM_PROMPT = """You are a strict document classification engine.
+Analyze the OCR-extracted text from document pages given in the user message.
 
 Your Goal: Return a list of page numbers containing **North American Government IDs**
 [USA, Canada, Mexico] ONLY.
@@ -89,25 +299,50 @@ RULES:
 4. **Exclude** everything other than IDs.
 5. Be Cautious with page number: Pages are respective of pdf file which starts with 1. Check the exact page which has structure.
     Return a JSON object with a 'matches' list. Each match must look like this:
-    {{
+    {
         'page': <int>, 
         'country_detected': string, 
         'doc_type': string 
-    }}
-PAGES:
-{''.join(pages_block)}
+    }
 """
 
+RESPONSE_FORMAT = NA_RESPONSE_FORMAT
+
+PROMPT_CACHE_KEY = "deepseek-na-docs"
+# Fixed start of every user message, ahead of the page blocks
+PAGES_HEADER = "PAGES:\n"
+
+async def analyze_batch(ocr_texts, start_page_num):
+    pages_block = []
+    for i, text in enumerate(ocr_texts):
+        page_no = start_page_num + i
+        if not NA_RE.search(text):
+            continue
+        pages_block.append(
+            f"\n--- PAGE {page_no} ---\n{text.strip()}"
+        )
+
+    if not pages_block:
+        print(f"  Pages {start_page_num}-{start_page_num + len(ocr_texts) - 1}: no NA keywords, skipping analysis")
+        return []
+
+    prompt = ''.join([PAGES_HEADER, *pages_block])
+
     try:
-        response = client.chat.completions.create(
-            model="gpt-5.2-pro",
+        response = await client.chat.completions.create(
+            model=CLASSIFIER_MODEL,
             messages=[
-                {"role": "system", "content": "You are a strict document classification engine."},
+                {"role": "system", "content": SYSTEM_PROMPT},
                 {"role": "user", "content": prompt}
             ],
-            response_format={"type": "json_object"},
+            response_format=RESPONSE_FORMAT,
+            prompt_cache_key=PROMPT_CACHE_KEY,
         )
 
+        usage = response.usage
+        cached_tokens = usage.prompt_tokens_details.cached_tokens if usage.prompt_tokens_details else 0
+        print(f"  Prompt tokens: {usage.prompt_tokens} ({cached_tokens} cached)")
+
         result = json.loads(response.choices[0].message.content)
         matches = result.get("matches", [])
 
@@ -122,51 +357,74 @@ PAGES:
         print(f"OCR batch error at page {start_page_num}: {e}")
         return []
 
-def main():
+async def main():
     if not os.path.exists(INPUT_PDF):
         print(f"Input file not found: {INPUT_PDF}")
         return
 
-    print("Converting PDF to images (300 DPI)...")
-    images = convert_from_path(INPUT_PDF, dpi=300)
-    total_pages = len(images)
+    try:
+        doc = pymupdf.open(INPUT_PDF)
+        total_pages = doc.page_count
+
+        identified_pages = []
+        tasks = []
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
-    identified_pages = []
+        async def guarded_analyze(ocr_texts, start_page):
+            async with semaphore:
+                return await analyze_batch(ocr_texts, start_page)
 
-    print(f"Running OCR + Analysis on {total_pages} pages...")
+        print(f"Running OCR + Analysis on {total_pages} pages...")
 
-    for i in range(0, total_pages, BATCH_SIZE):
-        batch_images = images[i:i + BATCH_SIZE]
-        start_page = i + 1
+        if NUM_GPUS > 1:
+            print(f"Sharding OCR across {NUM_GPUS} GPUs...")
+            page_texts = await asyncio.to_thread(ocr_multi_gpu, total_pages)
+            # Merge back in PDF page order, keeping the same batch boundaries
+            for start_page in range(1, total_pages + 1, BATCH_SIZE):
+                end_page = min(start_page + BATCH_SIZE, total_pages + 1)
+                ocr_texts = [page_texts[p] for p in range(start_page, end_page)]
+                tasks.append(asyncio.create_task(guarded_analyze(ocr_texts, start_page)))
+        else:
+            load_ocr_model()
 
-        print(f"Processing pages {start_page}-{start_page + len(batch_images) - 1}")
+            # Pages are rendered lazily, one batch at a time
+            batches = iter_batches(iter_pages(doc, dpi=OCR_DPI), BATCH_SIZE)
+            staged = ((len(batch), prepare_batch(batch)) for batch in batches)
+            # Render, preprocess and upload the next batch on a background thread
+            # while this one is processed
+            batch_idx = 0
+            async for num_pages, (inputs, copy_done) in prefetch_async(staged, maxsize=1):
+                start_page = batch_idx * BATCH_SIZE + 1
+                batch_idx += 1
 
-        ocr_texts = []
-        for img in batch_images:
-            text = ocr_image(img)
-            ocr_texts.append(text)
+                print(f"Processing pages {start_page}-{start_page + num_pages - 1}")
 
-        pages = analyze_batch(ocr_texts, start_page)
-        identified_pages.extend(pages)
+                # OCR runs in a worker thread so in-flight OpenAI requests keep progressing
+                ocr_texts = await asyncio.to_thread(ocr_batch, inputs, copy_done)
+                tasks.append(asyncio.create_task(guarded_analyze(ocr_texts, start_page)))
 
-    final_pages = sorted(set(identified_pages))
-    print(f"\nFinal Identified Pages: {final_pages}")
+        for pages in await asyncio.gather(*tasks):
+            identified_pages.extend(pages)
 
-    if final_pages:
-        reader = PdfReader(INPUT_PDF)
-        writer = PdfWriter()
-        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        final_pages = sorted(set(identified_pages))
+        print(f"\nFinal Identified Pages: {final_pages}")
 
-        for p in final_pages:
-            writer.add_page(reader.pages[p - 1])
+        if final_pages:
+            os.makedirs(OUTPUT_DIR, exist_ok=True)
+            output_path = os.path.join(OUTPUT_DIR, OUTPUT_FILENAME)
 
-        output_path = os.path.join(OUTPUT_DIR, OUTPUT_FILENAME)
-        with open(output_path, "wb") as f:
-            writer.write(f)
+            # Copy pages out of the document we already rendered from
+            with pymupdf.open() as out:
+                for p in final_pages:
+                    if 1 <= p <= total_pages:
+                        out.insert_pdf(doc, from_page=p - 1, to_page=p - 1)
+                out.save(output_path, garbage=3, deflate=True)
 
-        print(f"✅ Extracted PDF saved to: {output_path}")
-    else:
-        print("No matching pages found.")
+            print(f"✅ Extracted PDF saved to: {output_path}")
+        else:
+            print("No matching pages found.")
+    finally:
+        await http_client.aclose()
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -1,42 +1,50 @@
 import os
+import sys
 import json
+import httpx
 from dotenv import load_dotenv
 from openai import OpenAI
-from pypdf import PdfReader, PdfWriter
+import pikepdf
 load_dotenv()
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# One keep-alive HTTP/2 connection pool for every upload and response call,
+# so a run over several PDFs pays for the TCP+TLS handshake only once
+http_client = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=40)
+)
+# One Responses call covers a whole PDF, so keep OpenAI's 600 s limit
+# rather than the 60 s used for the per-batch classification calls
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client, timeout=600.0)
 
 INPUT_PDF = "./input/anyline-sample-scan-book-ocr.pdf"
 OUTPUT_DIR = "./output"
 OUTPUT_FILENAME = "anyline-sample-scan-book-ocr-na-id-only.pdf"
 
-def extract_pages(input_pdf, matches):
-    reader = PdfReader(input_pdf)
+def extract_pages(input_pdf, matches, output_filename=OUTPUT_FILENAME):
+    with pikepdf.open(input_pdf) as src, pikepdf.Pdf.new() as dst:
+        total_pages = len(src.pages)
 
-    total_pages = len(reader.pages)
+        # Walk the matches in page order, skipping repeats and out-of-range
+        # pages, and append straight to the output instead of collecting them
+        matches.sort(key=lambda m: m["page"])
+        prev = None
+        for m in matches:
+            page_num = m["page"]
+            if page_num == prev or not 1 <= page_num <= total_pages:
+                continue
+            # qpdf copies page objects by reference instead of re-serializing them
+            dst.pages.append(src.pages[page_num - 1])
+            prev = page_num
 
-    # Collect page numbers safely
-    pages = sorted({
-        m["page"]
-        for m in matches
-        if 1 <= m["page"] <= total_pages
-    })
+        if not len(dst.pages):
+            print("No valid pages to extract.")
+            return
 
-    if not pages:
-        print("No valid pages to extract.")
-        return
-    
-    writer = PdfWriter()
-
-    for page_num in pages:
-        writer.add_page(reader.pages[page_num - 1])
-
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-    output_path = os.path.join(OUTPUT_DIR, OUTPUT_FILENAME)
-
-    with open(output_path, "wb") as f:
-        writer.write(f)
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        output_path = os.path.join(OUTPUT_DIR, output_filename)
+        # Written straight to disk; object streams pack the copied objects compactly
+        dst.save(output_path, linearize=False, object_stream_mode=pikepdf.ObjectStreamMode.generate)
 
     print(f"✅ Extracted PDF saved to: {output_path}")
 
@@ -58,12 +66,16 @@ RULES:
     }}
 """
 
-def main():
+def analyze_pdf(pdf_path):
+    """
+    Uploads one PDF and returns the page matches from a single Responses call.
+    """
     # Upload PDF once
-    file = client.files.create(
-        file=open(INPUT_PDF, "rb"),
-        purpose="user_data"
-    )
+    with open(pdf_path, "rb") as f:
+        file = client.files.create(
+            file=f,
+            purpose="user_data"
+        )
 
     # Single Responses API call
     response = client.responses.create(
@@ -82,8 +94,23 @@ def main():
 
     result = json.loads(response.output_text)
     print(json.dumps(result, indent=2))
-    matches = result.get("matches", [])
-    extract_pages(INPUT_PDF, matches)
+    return result.get("matches", [])
+
+def main(pdf_paths):
+    try:
+        for pdf_path in pdf_paths:
+            print(f"Analyzing {pdf_path}...")
+            matches = analyze_pdf(pdf_path)
+
+            # Keep one output per input when several PDFs are processed
+            output_filename = OUTPUT_FILENAME
+            if len(pdf_paths) > 1:
+                stem = os.path.splitext(os.path.basename(pdf_path))[0]
+                output_filename = f"{stem}-{OUTPUT_FILENAME}"
+            extract_pages(pdf_path, matches, output_filename)
+    finally:
+        http_client.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # PDFs to process can be given on the command line; defaults to INPUT_PDF
+    main(sys.argv[1:] or [INPUT_PDF])
@@ -1,52 +1,93 @@
 import os, json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+import httpx
 from dotenv import load_dotenv
 from mistralai import Mistral
+from mistralai.models import OCRResponse
 from openai import OpenAI
-from pypdf import PdfReader, PdfWriter
+import pikepdf
+from classification import CLASSIFIER_MODEL, NA_RE, NA_RESPONSE_FORMAT
 
 load_dotenv()
 
 INPUT_PDF = "./input/anyline-sample-scan-book-ocr.pdf"
 OUTPUT_DIR = "./output"
 OUTPUT_FILENAME = "result.pdf"
-
-mistral = Mistral(api_key=os.getenv("MISTRAL_API_KEY"))
-openai = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# OCR output is deterministic for the same PDF bytes, so responses are kept
+# here keyed by the file's SHA-256 and re-used across runs
+CACHE_DIR = "./.cache/mistral_ocr"
+
+# One keep-alive HTTP/2 connection pool shared by the Mistral and OpenAI
+# clients, so each call reuses an open TLS session instead of dialling again
+http_client = httpx.Client(
+    http2=True,
+    timeout=60.0,
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64)
+)
+mistral = Mistral(api_key=os.getenv("MISTRAL_API_KEY"), client=http_client)
+openai = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client)
+
+def file_sha256(path):
+    """
+    Hex SHA-256 of the file's bytes, used as the OCR cache key. The file is
+    hashed in chunks rather than read into memory whole.
+    """
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
 
 def get_mistral_markdown(pdf_path):
-    print(f"1. Uploading '{pdf_path}' to Mistral OCR...")
-    
     try:
-        with open(pdf_path, "rb") as f:
-            uploaded_file = mistral.files.upload(
-                file={
-                    "file_name": os.path.basename(pdf_path),
-                    "content": f,
+        cache_path = os.path.join(CACHE_DIR, f"{file_sha256(pdf_path)}.json")
+
+        if os.path.exists(cache_path):
+            print(f"1. Reusing cached Mistral OCR for '{pdf_path}'...")
+            with open(cache_path, encoding="utf-8") as f:
+                ocr_response = OCRResponse.model_validate_json(f.read())
+        else:
+            print(f"1. Uploading '{pdf_path}' to Mistral OCR...")
+            # The SDK streams file objects into the multipart body, so the
+            # PDF is never held in memory in full
+            with open(pdf_path, "rb") as f:
+                uploaded_file = mistral.files.upload(
+                    file={
+                        "file_name": os.path.basename(pdf_path),
+                        "content": f,
+                    },
+                    purpose="ocr",
+                )
+
+            print(f"2. Processing OCR with Mistral (File ID: {uploaded_file.id})...")
+
+            signed_url = mistral.files.get_signed_url(file_id=uploaded_file.id)
+
+            ocr_response = mistral.ocr.process(
+                model="mistral-ocr-latest",
+                document={
+                    "type": "document_url",
+                    "document_url": signed_url.url,
                 },
-                purpose="ocr",
+                include_image_base64=False
             )
+
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(cache_path, "w", encoding="utf-8") as f:
+                f.write(ocr_response.model_dump_json())
         
-        print(f"2. Processing OCR with Mistral (File ID: {uploaded_file.id})...")
-        
-        signed_url = mistral.files.get_signed_url(file_id=uploaded_file.id)
-        
-        ocr_response = mistral.ocr.process(
-            model="mistral-ocr-latest",
-            document={
-                "type": "document_url",
-                "document_url": signed_url.url,
-            },
-            include_image_base64=False
-        )
-        
-        full_markdown = ""
+        # Collect page blocks and join once instead of growing a string
+        page_blocks = []
         # Mistral OCR returns a list of pages
         for i, page in enumerate(ocr_response.pages):
             page_num = i + 1
             # Mistral returns .markdown string for the page
             page_content = page.markdown
-            full_markdown += f"\n--- PAGE {page_num} ---\n{page_content}\n"
+            # Only pages that could hold a North American ID reach OpenAI
+            if not NA_RE.search(page_content):
+                continue
+            page_blocks.append(f"\n--- PAGE {page_num} ---\n{page_content}\n")
             
+        full_markdown = "".join(page_blocks)
         print("   OCR Complete.")
         return full_markdown, len(ocr_response.pages)
 
@@ -54,15 +95,8 @@ def get_mistral_markdown(pdf_path):
         print(f"Error in Mistral OCR: {e}")
         return None, 0
 
-def analyze_with_openai(markdown_text, total_pages):
-    """
-    Sends the Mistral Markdown to OpenAI with the specific NA ID prompt.
-    Ref: gpt-5.2-extract_na_docs.py prompt logic 
-    """
-    print("3. Sending OCR Markdown to OpenAI for NA ID Analysis...")
-
-    prompt = f"""
-Analyze the following OCR-extracted text from document pages.
+SYSTEM_PROMPT = """You are a strict document classification engine.
+Analyze the OCR-extracted text from document pages given in the user message.
 Your Goal: Return a list of page numbers containing **North American Government IDs**
 [USA, Canada, Mexico] ONLY.
 
@@ -74,26 +108,43 @@ RULES:
 5. Be Cautious with page number: Pages are respective of pdf file which starts with 1. Check the exact page which has structure.
 
 Return a JSON object with a 'matches' list. Each match must look like this:
-    {{
+    {
         'page': <int>, 
         'country_detected': string, 
         'doc_type': string 
-    }}
-
-PAGES CONTENT:
-{markdown_text}
+    }
 """
 
+RESPONSE_FORMAT = NA_RESPONSE_FORMAT
+
+PROMPT_CACHE_KEY = "mistral-na-docs"
+# Fixed start of every user message, ahead of the OCR markdown
+PAGES_HEADER = "PAGES CONTENT:\n"
+
+def analyze_with_openai(markdown_text, total_pages):
+    """
+    Sends the Mistral Markdown to OpenAI with the specific NA ID prompt.
+    Ref: gpt-5.2-extract_na_docs.py prompt logic 
+    """
+    print("3. Sending OCR Markdown to OpenAI for NA ID Analysis...")
+
+    prompt = PAGES_HEADER + markdown_text
+
     try:
         response = openai.chat.completions.create(
-            model="gpt-5.2",
+            model=CLASSIFIER_MODEL,
             messages=[
-                {"role": "system", "content": "You are a strict document classification engine."},
+                {"role": "system", "content": SYSTEM_PROMPT},
                 {"role": "user", "content": prompt}
             ],
-            response_format={"type": "json_object"},
+            response_format=RESPONSE_FORMAT,
+            prompt_cache_key=PROMPT_CACHE_KEY,
         )
 
+        usage = response.usage
+        cached_tokens = usage.prompt_tokens_details.cached_tokens if usage.prompt_tokens_details else 0
+        print(f"   Prompt tokens: {usage.prompt_tokens} ({cached_tokens} cached)")
+
         result = json.loads(response.choices[0].message.content)
         matches = result.get("matches", [])
 
@@ -113,27 +164,44 @@ PAGES CONTENT:
         print(f"Error in OpenAI Analysis: {e}")
         return []
 
-def split_and_save_pdf(original_pdf, pages_to_keep, output_dir, output_filename):
+def prewarm_openai():
+    """
+    Cheap metadata call that opens the OpenAI connection (DNS, TLS) while
+    Mistral OCR is still running, so the classification call reuses it.
+    """
+    try:
+        openai.models.retrieve(CLASSIFIER_MODEL)
+    except Exception:
+        pass
+
+def split_and_save_pdf(src, pages_to_keep, output_dir, output_filename):
     if not pages_to_keep:
         print("No matching pages found to extract.")
         return
 
     print(f"4. Extracting {len(pages_to_keep)} pages to new PDF...")
     
-    reader = PdfReader(original_pdf)
-    writer = PdfWriter()
-    
     os.makedirs(output_dir, exist_ok=True)
-    
-    for p in pages_to_keep:
-        try:
-            writer.add_page(reader.pages[p - 1])
-        except IndexError:
-            print(f"  Warning: Page {p} out of range, skipping.")
-
     output_path = os.path.join(output_dir, output_filename)
-    with open(output_path, "wb") as f:
-        writer.write(f)
+
+    # pikepdf (qpdf) copies page objects by reference instead of
+    # re-serializing every content stream in Python like pypdf
+    with pikepdf.Pdf.new() as dst:
+        page_count = len(src.pages)
+        valid_pages = []
+        for p in sorted(set(pages_to_keep)):
+            if 1 <= p <= page_count:
+                valid_pages.append(p)
+            else:
+                print(f"  Warning: Page {p} out of range, skipping.")
+
+        # Copy each run of consecutive pages with a single slice
+        for _, run in groupby(enumerate(valid_pages), key=lambda x: x[0] - x[1]):
+            run = [p for _, p in run]
+            dst.pages.extend(src.pages[run[0] - 1:run[-1]])
+
+        # Written straight to disk; object streams pack the copied objects compactly
+        dst.save(output_path, linearize=False, object_stream_mode=pikepdf.ObjectStreamMode.generate)
 
     print(f"✅ Extracted PDF saved to: {output_path}")
 
@@ -142,17 +210,29 @@ def main():
         print(f"Input file not found: {INPUT_PDF}")
         return
 
-    # Step 1: Mistral OCR
-    markdown_text, total_pages = get_mistral_markdown(INPUT_PDF)
-    
-    if not markdown_text:
-        return
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        # Warm up OpenAI and parse the source PDF while waiting on Mistral OCR
+        executor.submit(prewarm_openai)
+        src_future = executor.submit(pikepdf.open, INPUT_PDF)
+
+        # Step 1: Mistral OCR
+        markdown_text, total_pages = get_mistral_markdown(INPUT_PDF)
 
-    # Step 2: OpenAI Analysis
-    target_pages = analyze_with_openai(markdown_text, total_pages)
+    with src_future.result() as src:
+        if markdown_text is None:
+            return
+        if not markdown_text:
+            print("No page mentions a North American country or ID keyword.")
+            return
 
-    # Step 3: PDF Split
-    split_and_save_pdf(INPUT_PDF, target_pages, OUTPUT_DIR, OUTPUT_FILENAME)
+        # Step 2: OpenAI Analysis
+        target_pages = analyze_with_openai(markdown_text, total_pages)
+
+        # Step 3: PDF Split
+        split_and_save_pdf(src, target_pages, OUTPUT_DIR, OUTPUT_FILENAME)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    try:
+        main()
+    finally:
+        http_client.close()
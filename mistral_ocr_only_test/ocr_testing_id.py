@@ -1,36 +1,57 @@
 import os, base64
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from mistralai import Mistral
+from mistralai.models import OCRResponse
 load_dotenv()
 
 INPUT_PDF = "./input/anyline-sample-scan-book-ocr.pdf"
 OUTPUT_DIR = "./output/md_with_img_id"
 OUTPUT_FILENAME = "anyline-sample-scan-book-ocr.md"
+# OCR responses keyed by the PDF's SHA-256, re-used across runs. Responses
+# here embed the base64 images, so they are kept apart from the text-only ones
+CACHE_DIR = "./.cache/mistral_ocr"
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 client = Mistral(api_key=os.getenv('MISTRAL_API_KEY'))
-uploaded_file = client.files.upload(
-    file = {
-        "file_name" : "school-text-ocr-test.pdf",
-        "content" : open(INPUT_PDF, "rb")
-    },
-    purpose="ocr"
-)
-file_url = client.files.get_signed_url(file_id=uploaded_file.id)
-
-response = client.ocr.process(
-    model='mistral-ocr-latest',
-    document={
-        "type" : "document_url",
-        "document_url" : file_url.url
-    },
-    include_image_base64=True
-)
+
+with open(INPUT_PDF, "rb") as f:
+    pdf_sha256 = hashlib.file_digest(f, "sha256").hexdigest()
+cache_path = os.path.join(CACHE_DIR, f"{pdf_sha256}-images.json")
+
+if os.path.exists(cache_path):
+    with open(cache_path, encoding="utf-8") as f:
+        response = OCRResponse.model_validate_json(f.read())
+else:
+    # The file object is streamed into the upload and closed afterwards
+    with open(INPUT_PDF, "rb") as pdf_file:
+        uploaded_file = client.files.upload(
+            file = {
+                "file_name" : "school-text-ocr-test.pdf",
+                "content" : pdf_file
+            },
+            purpose="ocr"
+        )
+    file_url = client.files.get_signed_url(file_id=uploaded_file.id)
+
+    response = client.ocr.process(
+        model='mistral-ocr-latest',
+        document={
+            "type" : "document_url",
+            "document_url" : file_url.url
+        },
+        include_image_base64=True
+    )
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(cache_path, "w", encoding="utf-8") as f:
+        f.write(response.model_dump_json())
 
 def data_uri_to_bytes(data_uri):
-    _, encoded = data_uri.split(',', 1)
-    return base64.b64decode(encoded)
+    # Slice past the "data:...;base64," header instead of splitting the string
+    return base64.b64decode(data_uri[data_uri.index(',') + 1:], validate=False)
 
 def export_image(image):
     parsed_image = data_uri_to_bytes(image.image_base64)
@@ -43,5 +64,9 @@ with open(md_path, "w", encoding="utf-8") as f:
     for page_num, page in enumerate(response.pages, start=1):
         f.write(f"\n\n----PDF PAGE {page_num}----\n\n")
         f.write(page.markdown)
-        for image in page.images:
-            export_image(image)
\ No newline at end of file
+
+# Decoding and writing images is independent per image and both release the
+# GIL, so export them on a thread pool
+all_images = [image for page in response.pages for image in page.images]
+with ThreadPoolExecutor(max_workers=16) as executor:
+    list(executor.map(export_image, all_images))
@@ -0,0 +1,555 @@
+import os
+import asyncio
+import atexit
+import hashlib
+import json
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import groupby
+import httpx
+from dotenv import load_dotenv
+from openai import AsyncOpenAI, OpenAI, RateLimitError
+import numpy as np
+import cv2
+import pymupdf
+import tiktoken
+import tesserocr
+from tesserocr import PyTessBaseAPI, OEM, PSM
+from PIL import Image
+from classification import CLASSIFIER_MODEL
+from page_stream import prefetch
+
+load_dotenv()
+
+# 300 DPI ensures Tesseract can read small headers and fine print clearly
+OCR_DPI = 300
+# Pages whose embedded text layer has more characters than this use it
+# as-is and are never rendered or OCR'd, unless images cover more than
+# MAX_TEXT_LAYER_IMAGE_COVER of the page: there the text layer is often just
+# a menu or caption over a scanned page, so the page is OCR'd instead
+MIN_TEXT_LAYER_CHARS = 100
+MAX_TEXT_LAYER_IMAGE_COVER = 0.1
+# OCR results are kept here keyed by the PDF's SHA-256 and a hash of every
+# setting that changes the text (see ocr_pdf), so a run with another prompt
+# skips OCR
+CACHE_DIR = "./.cache/tesseract_ocr"
+# Gaussian adaptive threshold: neighbourhood size in pixels and the offset
+# subtracted from the local mean
+THRESHOLD_BLOCK_SIZE = 31
+THRESHOLD_C = 10
+# Larger skew estimates come from photos or layout rather than tilted text
+MAX_DESKEW_ANGLE = 10
+# LSTM-only recognition is faster and more accurate than the combined
+# legacy + LSTM engine
+OCR_OEM = OEM.LSTM_ONLY
+# Running-text detection for block_text_pages, on the binarised page inside
+# its text bounding box (the rows and columns with more than 1% ink): light
+# ink overall, most of it in glyph-sized connected components. Glyph sizes
+# are pixels at OCR_DPI and are scaled to the render DPI; TEXT_MIN_GLYPHS
+# counts characters on the page, which the DPI does not change
+TEXT_BOX_MIN_INK = 0.01
+TEXT_MAX_INK = 0.14
+GLYPH_MIN_HEIGHT = 10
+GLYPH_MAX_SIZE = 80
+TEXT_MIN_GLYPHS = 500
+TEXT_MIN_GLYPH_SHARE = 0.3
+
+# Pages are packed into one request up to this many tokens of OCR text,
+# counted with tiktoken, leaving headroom for the prompts and the answer
+MAX_BATCH_TOKENS = 90_000
+TOKEN_ENCODING = "o200k_base"
+# Batches analysed concurrently, and the account's OpenAI rate limits
+MAX_CONCURRENT_REQUESTS = 8
+MAX_REQUESTS_PER_MINUTE = 500
+MAX_TOKENS_PER_MINUTE = 200_000
+MAX_RETRIES = 5
+# Keep-alive pool for the OpenAI clients; over HTTP/2 the concurrent batch
+# requests share one TLS session instead of each opening a connection
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+# Batch API (--batch): half price, results within 24h. Status polling starts
+# at the first interval and doubles up to the second
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_POLL_INTERVAL = 10
+MAX_BATCH_POLL_INTERVAL = 300
+
+# Tesseract engine of this OCR worker process, created once by _init_api(),
+# with its page segmentation mode, whether running-text pages switch to
+# SINGLE_BLOCK and the DPI pages are rendered at
+api = None
+page_psm = PSM.AUTO
+block_text = False
+page_dpi = OCR_DPI
+
+def _init_api(psm=PSM.AUTO, block_text_pages=False, dpi=OCR_DPI):
+    """
+    Pool initializer: loads eng.traineddata once per worker process and keeps
+    the engine open for every page that process OCRs.
+    """
+    global api, page_psm, block_text, page_dpi
+    page_psm, block_text, page_dpi = psm, block_text_pages, dpi
+    api = PyTessBaseAPI(lang="eng", psm=psm, oem=OCR_OEM)
+    atexit.register(api.End)
+
+def is_running_text(arr):
+    """
+    True for a binarised page that is plain running text: light ink inside
+    the text bounding box, most of it in glyph-sized components. Photos,
+    ID cards and mixed layouts return False.
+    """
+    dark = arr < 128
+    rows = np.flatnonzero(dark.mean(axis=1) > TEXT_BOX_MIN_INK)
+    cols = np.flatnonzero(dark.mean(axis=0) > TEXT_BOX_MIN_INK)
+    if not len(rows) or not len(cols):
+        return False
+    box = dark[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    if box.mean() > TEXT_MAX_INK:
+        return False
+
+    scale = page_dpi / OCR_DPI
+    min_height, max_size = GLYPH_MIN_HEIGHT * scale, GLYPH_MAX_SIZE * scale
+    _, _, stats, _ = cv2.connectedComponentsWithStats(box.view(np.uint8), connectivity=8)
+    heights = stats[1:, cv2.CC_STAT_HEIGHT]
+    widths = stats[1:, cv2.CC_STAT_WIDTH]
+    glyphs = np.count_nonzero((heights >= min_height) & (heights <= max_size) & (widths <= max_size))
+    return glyphs >= TEXT_MIN_GLYPHS and glyphs >= TEXT_MIN_GLYPH_SHARE * len(heights)
+
+def choose_psm(arr):
+    """
+    Page segmentation mode for one binarised page: SINGLE_BLOCK, which skips
+    Tesseract's layout analysis, for running text when block_text_pages is
+    on, otherwise the worker's fixed mode.
+    """
+    if block_text and page_psm != PSM.SINGLE_BLOCK and is_running_text(arr):
+        return PSM.SINGLE_BLOCK
+    return page_psm
+
+def _estimate_skew(binary):
+    """
+    Rotation in degrees that levels the text on a binarised page, from the
+    minimum-area rectangle around all dark (text) pixels.
+    """
+    coords = cv2.findNonZero(255 - binary)
+    if coords is None:
+        return 0.0
+    angle = cv2.minAreaRect(coords)[-1]
+    # OpenCV versions report the rectangle angle in different 90 degree
+    # ranges; fold it into (-45, 45]
+    return (angle + 45) % 90 - 45
+
+def _rotate(arr, angle):
+    """
+    Rotates a grayscale page about its centre, filling the corners with white.
+    """
+    height, width = arr.shape
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    return cv2.warpAffine(arr, matrix, (width, height), flags=cv2.INTER_NEAREST, borderValue=255)
+
+def preprocess(image):
+    """
+    Binarises a page with a Gaussian adaptive threshold and deskews it, so
+    Tesseract gets clean, level 1-bit-like input and its own thresholding
+    has nothing left to do.
+    """
+    arr = np.asarray(image if image.mode == "L" else image.convert("L"))
+    arr = cv2.adaptiveThreshold(arr, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, THRESHOLD_BLOCK_SIZE, THRESHOLD_C)
+    angle = _estimate_skew(arr)
+    if 0.1 < abs(angle) <= MAX_DESKEW_ANGLE:
+        arr = _rotate(arr, angle)
+    return Image.fromarray(arr)
+
+def ocr_image(image: Image.Image) -> str | None:
+    """
+    Runs Tesseract OCR on a PIL image. Returns None if OCR failed, so the
+    caller can tell a failed page from a blank one.
+    """
+    if api is None:
+        _init_api()
+    try:
+        page = preprocess(image)
+        if block_text:
+            api.SetPageSegMode(choose_psm(np.asarray(page)))
+        api.SetImage(page)
+        return api.GetUTF8Text()
+    except Exception as e:
+        print(f"OCR Error: {e}")
+        return None
+
+def _get_max_workers():
+    """
+    Number of OCR worker processes: all cores but one, which is left for
+    page rendering and the main process.
+    """
+    return max(1, (os.cpu_count() or 1) - 1)
+
+def image_cover(page):
+    """
+    Fraction of the page area covered by its images, summing the on-page part
+    of each image's bounding box (overlaps count twice).
+    """
+    covered = sum(abs(pymupdf.Rect(info["bbox"]) & page.rect) for info in page.get_image_info())
+    return covered / abs(page.rect) if abs(page.rect) else 0.0
+
+def iter_pages(doc, dpi=300, min_text_chars=None, max_image_cover=MAX_TEXT_LAYER_IMAGE_COVER):
+    """
+    Renders PDF pages one at a time so only the current page is held in memory.
+    Pages come out as 8-bit grayscale: Tesseract converts to gray anyway, and
+    a third of the RGB bytes is rendered and sent to the OCR workers.
+    With `min_text_chars`, a page whose text layer is longer than that, and
+    whose images cover at most `max_image_cover` of it, is yielded as its
+    text (a str) instead of being rendered.
+    """
+    for page in doc:
+        if min_text_chars is not None:
+            native = page.get_text("text")
+            if len(native.strip()) > min_text_chars and image_cover(page) <= max_image_cover:
+                yield native
+                continue
+        pix = page.get_pixmap(dpi=dpi, colorspace=pymupdf.csGRAY)
+        yield Image.frombytes("L", (pix.width, pix.height), pix.samples)
+
+def ocr_pages(executor, ocr_fn, images, max_pending):
+    """
+    Yields ocr_fn(image) for every page, in page order, keeping at most
+    `max_pending` pages submitted to `executor`. Executor.map would pull
+    (and render) every page up front; this keeps peak memory at a few pages
+    per worker. Pages that are already text are passed through in order.
+    """
+    pending = deque()
+    for image in images:
+        if isinstance(image, str):
+            future = Future()
+            future.set_result(image)
+        else:
+            future = executor.submit(ocr_fn, image)
+        pending.append(future)
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def file_sha256(path):
+    """
+    Hex SHA-256 of the file's bytes, hashed in chunks rather than read whole.
+    """
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+def ocr_pdf(pdf_path, dpi=OCR_DPI, psm=PSM.AUTO, block_text_pages=False) -> dict[int, str]:
+    """
+    OCRs every page of a PDF with Tesseract and returns {page_number: text},
+    1-based; pages that carry a text layer use it instead. `psm` is the page
+    segmentation mode; with `block_text_pages`, pages detected as running
+    text are read as a single block instead. Results are cached on disk, so
+    the same PDF is only OCR'd once per set of OCR, text-layer and
+    preprocessing settings; a run in which any page failed is not cached.
+    """
+    version = tesserocr.tesseract_version().split()[1]
+    settings = (
+        dpi, version, int(psm), int(OCR_OEM), MIN_TEXT_LAYER_CHARS, MAX_TEXT_LAYER_IMAGE_COVER,
+        THRESHOLD_BLOCK_SIZE, THRESHOLD_C, MAX_DESKEW_ANGLE, block_text_pages,
+    )
+    if block_text_pages:
+        settings += (
+            TEXT_BOX_MIN_INK, TEXT_MAX_INK, GLYPH_MIN_HEIGHT, GLYPH_MAX_SIZE,
+            TEXT_MIN_GLYPHS, TEXT_MIN_GLYPH_SHARE,
+        )
+    # Any setting above changes the text, so each set gets its own entry
+    settings_key = hashlib.sha256(repr(settings).encode()).hexdigest()[:16]
+    cache_path = os.path.join(CACHE_DIR, f"{file_sha256(pdf_path)}-{settings_key}.json")
+
+    if os.path.exists(cache_path):
+        print(f"  Reusing cached OCR for '{pdf_path}'")
+        with open(cache_path, encoding="utf-8") as f:
+            return {int(page_num): text for page_num, text in json.load(f).items()}
+
+    page_map = {}
+    failed_pages = []
+    workers = _get_max_workers()
+    with pymupdf.open(pdf_path) as doc:
+        total_pages = doc.page_count
+        # Pages are rendered lazily on a background thread, a few ahead of the
+        # OCR; pages with a usable text layer skip rendering and OCR entirely
+        pages = prefetch(iter_pages(doc, dpi=dpi, min_text_chars=MIN_TEXT_LAYER_CHARS), maxsize=workers)
+        # Tesseract is CPU-bound and pages are independent, so OCR them on a
+        # pool of worker processes instead of one after another
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_api, initargs=(psm, block_text_pages, dpi)) as executor:
+            texts = ocr_pages(executor, ocr_image, pages, max_pending=2 * workers)
+            for page_num, text in enumerate(texts, start=1):
+                print(f"  - OCR Scanning Page {page_num}/{total_pages}...", end="\r")
+                if text is None:
+                    failed_pages.append(page_num)
+                    text = ""
+                page_map[page_num] = text
+    print()
+
+    # A failure may be transient (e.g. out of memory), so it must not leave
+    # the page blank in the cache for every later run
+    if failed_pages:
+        print(f"  OCR failed on pages {failed_pages}; results are not cached")
+        return page_map
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(cache_path, "w", encoding="utf-8") as f:
+        json.dump(page_map, f)
+
+    return page_map
+
+def pack_by_tokens(page_map, encoding, max_tokens):
+    """
+    Greedily groups {page_number: text} into dicts whose combined token count
+    stays within `max_tokens`, yielding (batch, token_count) pairs. Short
+    pages share one request, and a page larger than the budget is sent on
+    its own rather than truncated.
+    """
+    batch, batch_tokens = {}, 0
+    for page_num, text in page_map.items():
+        tokens = len(encoding.encode(text))
+        if batch and batch_tokens + tokens > max_tokens:
+            yield batch, batch_tokens
+            batch, batch_tokens = {}, 0
+        batch[page_num] = text
+        batch_tokens += tokens
+    if batch:
+        yield batch, batch_tokens
+
+class RateLimiter:
+    """
+    Client-side request and token budget, after the openai-cookbook
+    api_request_parallel_processor: both capacities refill continuously up
+    to their per-minute limits and each call waits until it fits in both.
+    """
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = requests_per_minute
+        self.available_tokens = tokens_per_minute
+        self.last_update = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens):
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                elapsed = now - self.last_update
+                self.last_update = now
+                self.available_requests = min(
+                    self.requests_per_minute,
+                    self.available_requests + self.requests_per_minute * elapsed / 60
+                )
+                self.available_tokens = min(
+                    self.tokens_per_minute,
+                    self.available_tokens + self.tokens_per_minute * elapsed / 60
+                )
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                await asyncio.sleep(0.1)
+
+async def create_chat_completion(client, rate_limiter, prompt_tokens, **kwargs):
+    """
+    Calls chat.completions.create within the rate limits, charging
+    `prompt_tokens` against the TPM budget, and retries with exponential
+    backoff when the API still answers 429.
+    """
+    for attempt in range(MAX_RETRIES):
+        await rate_limiter.acquire(prompt_tokens)
+        try:
+            return await client.chat.completions.create(**kwargs)
+        except RateLimitError:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            delay = 2 ** attempt
+            print(f"  Rate limited, retrying in {delay}s...")
+            await asyncio.sleep(delay)
+
+def build_messages(page_text_map, prompt):
+    """
+    Chat messages for one batch: the static system prompt, then the OCR text
+    of every page in `page_text_map`.
+    """
+    # The header goes into the same join, so the page text is copied once
+    page_blocks = [f"Extracted text from {len(page_text_map)} pages:\n\n"]
+    for page_num, text in page_text_map.items():
+        clean_text = text.replace('\n', ' ').strip()
+        page_blocks.append(f"--- PAGE {page_num} START ---\n{clean_text}\n--- PAGE {page_num} END ---\n\n")
+    user_prompt = "".join(page_blocks)
+
+    return [
+        {"role": "system", "content": prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+def parse_matches(content):
+    """
+    Prints and returns the page numbers of a structured 'matches' answer.
+    """
+    result = json.loads(content)
+    matches = result.get("matches", [])
+
+    valid_pages = []
+    for m in matches:
+        details = ", ".join(f"{key}: {value}" for key, value in m.items() if key != "page")
+        print(f"  -> Found Page {m['page']}: {details}")
+        valid_pages.append(m["page"])
+
+    return valid_pages
+
+async def analyze_text_batch(client, rate_limiter, page_text_map, prompt_tokens, prompt, response_format, prompt_cache_key):
+    """
+    Sends EXTRACTED TEXT (not images) to OpenAI and returns the matched pages.
+    `prompt_tokens` is the tiktoken count of the request, for the rate limiter.
+    """
+    try:
+        response = await create_chat_completion(
+            client,
+            rate_limiter,
+            prompt_tokens,
+            model=CLASSIFIER_MODEL,
+            messages=build_messages(page_text_map, prompt),
+            response_format=response_format,
+            prompt_cache_key=prompt_cache_key,
+        )
+
+        usage = response.usage
+        cached_tokens = usage.prompt_tokens_details.cached_tokens if usage.prompt_tokens_details else 0
+        print(f"  Prompt tokens: {usage.prompt_tokens} ({cached_tokens} cached)")
+
+        return parse_matches(response.choices[0].message.content)
+
+    except Exception as e:
+        print(f"Error in AI analysis at page {min(page_text_map)}: {e}")
+        return []
+
+async def _classify_pages(page_map, prompt, response_format, prompt_cache_key):
+    encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+    rate_limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE, MAX_TOKENS_PER_MINUTE)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    # The static system prompt is part of every request's token cost
+    system_tokens = len(encoding.encode(prompt))
+
+    async def guarded_analyze(page_text_map, page_tokens):
+        async with semaphore:
+            return await analyze_text_batch(
+                client, rate_limiter, page_text_map, system_tokens + page_tokens,
+                prompt, response_format, prompt_cache_key
+            )
+
+    async with (
+        httpx.AsyncClient(http2=True, timeout=60.0, limits=HTTP_LIMITS) as http_client,
+        AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client) as client,
+    ):
+        tasks = []
+        for page_text_map, page_tokens in pack_by_tokens(page_map, encoding, MAX_BATCH_TOKENS):
+            print(f"  Sending pages {min(page_text_map)}-{max(page_text_map)} to {CLASSIFIER_MODEL}...")
+            tasks.append(guarded_analyze(page_text_map, page_tokens))
+        results = await asyncio.gather(*tasks)
+
+    return [page for pages in results for page in pages]
+
+def _classify_pages_batch(page_map, prompt, response_format, prompt_cache_key):
+    """
+    Submits every packed batch as one OpenAI Batch API job, polls it until it
+    finishes and returns the matched pages of all successful requests.
+    """
+    encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+    lines = []
+    for page_text_map, _ in pack_by_tokens(page_map, encoding, MAX_BATCH_TOKENS):
+        body = {
+            "model": CLASSIFIER_MODEL,
+            "messages": build_messages(page_text_map, prompt),
+            "response_format": response_format,
+        }
+        if prompt_cache_key:
+            body["prompt_cache_key"] = prompt_cache_key
+        lines.append(json.dumps({
+            "custom_id": f"batch-{min(page_text_map)}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": body,
+        }))
+
+    with (
+        httpx.Client(http2=True, timeout=60.0, limits=HTTP_LIMITS) as http_client,
+        OpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client) as client,
+    ):
+        batch_input = client.files.create(
+            file=("batch.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch",
+        )
+        batch = client.batches.create(
+            input_file_id=batch_input.id,
+            endpoint="/v1/chat/completions",
+            completion_window=BATCH_COMPLETION_WINDOW,
+        )
+        print(f"  Submitted {len(lines)} requests as batch {batch.id}, waiting for results...")
+
+        delay = BATCH_POLL_INTERVAL
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_BATCH_POLL_INTERVAL)
+            batch = client.batches.retrieve(batch.id)
+            counts = batch.request_counts
+            print(f"  Batch {batch.status}: {counts.completed if counts else 0}/{counts.total if counts else '?'} done")
+
+        if batch.status != "completed" and not batch.output_file_id:
+            print(f"Error: batch {batch.id} ended as '{batch.status}'.")
+            return []
+        if batch.request_counts and batch.request_counts.failed:
+            print(f"  Warning: {batch.request_counts.failed} requests failed (see file {batch.error_file_id}).")
+        if not batch.output_file_id:
+            return []
+
+        output = client.files.content(batch.output_file_id).text
+
+    pages = []
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            print(f"Error in AI analysis for {result['custom_id']}: {result.get('error')}")
+            continue
+        try:
+            pages.extend(parse_matches(response["body"]["choices"][0]["message"]["content"]))
+        except Exception as e:
+            print(f"Error in AI analysis for {result['custom_id']}: {e}")
+
+    return pages
+
+def classify_pages(page_map, prompt, response_format, prompt_cache_key=None, page_filter=None, use_batch_api=False) -> list[int]:
+    """
+    Asks CLASSIFIER_MODEL which pages of {page_number: text} match `prompt`
+    (the static system prompt) and returns the sorted, de-duplicated page
+    numbers. `page_filter(text)` can drop pages locally before any request
+    is made; batches are packed by token budget and sent concurrently, or
+    as one Batch API job when `use_batch_api` is set.
+    """
+    if page_filter is not None:
+        page_map = {page_num: text for page_num, text in page_map.items() if page_filter(text)}
+    if not page_map:
+        print("  No candidate pages to classify.")
+        return []
+
+    if use_batch_api:
+        pages = _classify_pages_batch(page_map, prompt, response_format, prompt_cache_key)
+    else:
+        pages = asyncio.run(_classify_pages(page_map, prompt, response_format, prompt_cache_key))
+    # Only pages that were actually sent can be valid matches
+    return sorted({p for p in pages if p in page_map})
+
+def save_pages(pdf_path, pages, output_path):
+    """
+    Copies the given 1-based pages of `pdf_path` into a new PDF at `output_path`.
+    """
+    with pymupdf.open(pdf_path) as doc, pymupdf.open() as out:
+        valid_pages = sorted({p for p in pages if 1 <= p <= doc.page_count})
+        # One insert_pdf() per run of consecutive pages, so shared resources
+        # are copied once per run rather than once per page
+        for _, run in groupby(enumerate(valid_pages), key=lambda x: x[0] - x[1]):
+            run = [p for _, p in run]
+            out.insert_pdf(doc, from_page=run[0] - 1, to_page=run[-1] - 1)
+        out.save(output_path, garbage=3, deflate=True)
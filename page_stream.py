@@ -0,0 +1,83 @@
+import asyncio
+import hashlib
+import queue
+import threading
+from itertools import islice
+from PIL import Image
+
+# Page rendering and batching shared by the local-model scripts, so pages
+# are rendered lazily and ahead of the model the same way everywhere
+
+def iter_pages(doc, dpi=300):
+    """
+    Renders PDF pages one at a time so only the current page is held in memory.
+    """
+    for page in doc:
+        pix = page.get_pixmap(dpi=dpi)
+        yield Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+
+def iter_batches(iterable, size):
+    """
+    Groups an iterable into lists of at most `size` items.
+    """
+    it = iter(iterable)
+    while batch := list(islice(it, size)):
+        yield batch
+
+def page_digest(image):
+    """
+    Content hash of a rendered page; pixel-identical pages (repeated
+    templates, blank pages) share a digest and are only run through the
+    model once.
+    """
+    return image.size, hashlib.blake2b(image.tobytes(), digest_size=16).digest()
+
+def _start_prefetch(iterable, maxsize):
+    """
+    Starts a background thread that consumes `iterable` into a bounded queue
+    and returns the queue with the sentinel that marks its end.
+    """
+    q = queue.Queue(maxsize=maxsize)
+    done = object()
+
+    def producer():
+        try:
+            for item in iterable:
+                q.put((item, None))
+        except Exception as e:
+            q.put((done, e))
+        else:
+            q.put((done, None))
+
+    threading.Thread(target=producer, daemon=True).start()
+    return q, done
+
+def prefetch(iterable, maxsize=2):
+    """
+    Consumes `iterable` on a background thread, keeping up to `maxsize` items
+    ready so page rendering overlaps with OCR or model inference.
+    The PDF document is only touched by that thread until it is exhausted.
+    """
+    q, done = _start_prefetch(iterable, maxsize)
+    while True:
+        item, error = q.get()
+        if item is done:
+            if error is not None:
+                raise error
+            return
+        yield item
+
+async def prefetch_async(iterable, maxsize=2):
+    """
+    prefetch() for the event loop: waiting on the next item happens in a
+    worker thread, so in-flight OpenAI requests keep progressing while the
+    next batch renders.
+    """
+    q, done = _start_prefetch(iterable, maxsize)
+    while True:
+        item, error = await asyncio.to_thread(q.get)
+        if item is done:
+            if error is not None:
+                raise error
+            return
+        yield item
@@ -1,43 +1,20 @@
-import os, json
-import json
-from dotenv import load_dotenv
-from openai import OpenAI
-from pdf2image import convert_from_path
-from pypdf import PdfReader, PdfWriter
-import pytesseract
-from PIL import Image
-
-load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+import argparse
+import os
+from tesserocr import PSM
+from ocr_pipeline import ocr_pdf, classify_pages, save_pages
+from classification import NA_RE, NA_RESPONSE_FORMAT
 
 INPUT_PDF = "./input/anyline-sample-scan-book-ocr.pdf"
 OUTPUT_DIR = "./output"
 OUTPUT_FILENAME = "anyline-sample-scan-book-ocr-tesseract.pdf"
-BATCH_SIZE = 10
-
-def ocr_image(image: Image.Image) -> str:
-    """
-    Runs Tesseract OCR on a PIL image.
-    """
-    return pytesseract.image_to_string(
-        image,
-        lang="eng",
-        config="--psm 6"
-    )
+# ID cards, passports and photos hold short, scattered fields that a single
+# block (the former --psm 6) runs together, so those pages use sparse text
+# (--psm 11); pages of plain running text are still read as one block
+OCR_PSM = PSM.SPARSE_TEXT
+BLOCK_TEXT_PAGES = True
 
-def analyze_batch(ocr_texts, start_page_num):
-    """
-    Sends OCR TEXT (not images) to OpenAI.
-    """
-    pages_block = []
-    for i, text in enumerate(ocr_texts):
-        page_no = start_page_num + i
-        pages_block.append(
-            f"\n--- PAGE {page_no} ---\n{text.strip()}"
-        )
-
-    prompt = f"""
-Analyze the following OCR-extracted text from document pages.
+SYSTEM_PROMPT = """You are a strict document classification engine.
+Analyze the OCR-extracted text from document pages given in the user message.
 
 GOAL:
 Return ONLY pages that contain **North American Government IDs**
@@ -49,85 +26,46 @@ RULES:
 3. Exclude non-ID documents (meters, barcodes, license plates, etc).
 
 Return JSON ONLY in this format:
-{{
+{
   "matches": [
-    {{ "page": int, "country_detected": string, "doc_type": string }}
+    { "page": int, "country_detected": string, "doc_type": string }
   ]
-}}
-
-PAGES:
-{''.join(pages_block)}
+}
 """
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-5.2-pro",
-            messages=[
-                {"role": "system", "content": "You are a strict document classification engine."},
-                {"role": "user", "content": prompt}
-            ],
-            response_format={"type": "json_object"},
-        )
+RESPONSE_FORMAT = NA_RESPONSE_FORMAT
 
-        result = json.loads(response.choices[0].message.content)
-        matches = result.get("matches", [])
+PROMPT_CACHE_KEY = "tesseract-na-docs"
 
-        valid_pages = []
-        for m in matches:
-            print(f"  -> Found Page {m['page']}: {m['country_detected']} ({m['doc_type']})")
-            valid_pages.append(m["page"])
-
-        return valid_pages
-
-    except Exception as e:
-        print(f"OCR batch error at page {start_page_num}: {e}")
-        return []
-
-def main():
+def main(use_batch_api=False):
     if not os.path.exists(INPUT_PDF):
         print(f"Input file not found: {INPUT_PDF}")
         return
 
-    print("Converting PDF to images (300 DPI)...")
-    images = convert_from_path(INPUT_PDF, dpi=300)
-    total_pages = len(images)
-
-    identified_pages = []
+    # 1. Local OCR Extraction (cached, so a new prompt re-uses it)
+    print(f"Step 1: OCR of '{INPUT_PDF}'...")
+    page_map = ocr_pdf(INPUT_PDF, psm=OCR_PSM, block_text_pages=BLOCK_TEXT_PAGES)
 
-    print(f"Running OCR + Analysis on {total_pages} pages...")
-
-    for i in range(0, total_pages, BATCH_SIZE):
-        batch_images = images[i:i + BATCH_SIZE]
-        start_page = i + 1
-
-        print(f"Processing pages {start_page}-{start_page + len(batch_images) - 1}")
-
-        ocr_texts = []
-        for img in batch_images:
-            text = ocr_image(img)
-            ocr_texts.append(text)
-
-        pages = analyze_batch(ocr_texts, start_page)
-        identified_pages.extend(pages)
-
-    final_pages = sorted(set(identified_pages))
+    # 2. AI Text Analysis
+    print(f"Step 2: Analyzing {len(page_map)} pages...")
+    final_pages = classify_pages(page_map, SYSTEM_PROMPT, RESPONSE_FORMAT, PROMPT_CACHE_KEY, page_filter=NA_RE.search, use_batch_api=use_batch_api)
     print(f"\nFinal Identified Pages: {final_pages}")
 
+    # 3. PDF Extraction
     if final_pages:
-        reader = PdfReader(INPUT_PDF)
-        writer = PdfWriter()
         os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-        for p in final_pages:
-            writer.add_page(reader.pages[p - 1])
-
         output_path = os.path.join(OUTPUT_DIR, OUTPUT_FILENAME)
-        with open(output_path, "wb") as f:
-            writer.write(f)
-
+        save_pages(INPUT_PDF, final_pages, output_path)
         print(f"✅ Extracted PDF saved to: {output_path}")
     else:
         print("No matching pages found.")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="OCR a scanned PDF with Tesseract and extract the matching pages.")
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Classify through the OpenAI Batch API: half the cost, results within 24h"
+    )
+    args = parser.parse_args()
+    main(use_batch_api=args.batch)